@@ -1,106 +1,303 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context
 from docx import Document
 from docx.shared import Pt, Inches
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from datetime import datetime
+import atexit
+import concurrent.futures
+import copy
+import fitz
+import functools
+import io
+import json
 import os
+import queue
 import platform
+import re
+import shutil
+import socket
 import subprocess
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
 import base64
+from xml.sax.saxutils import escape as xml_escape
+
+try:
+    import fcntl
+except ImportError:  # Windows development; single process assumed
+    fcntl = None
 
 app = Flask(__name__)
 
 # Path to store the serial number counter
 SERIAL_FILE = "serial_data.txt"
 
-def get_serial_number():
-    # Read base number and counter from file
-    with open(SERIAL_FILE, "r") as f:
-        base_number, counter = map(int, f.read().strip().split(","))
-
-    # Calculate current serial number
-    serial_number = base_number + counter
+# Serials are issued from an in-memory block and persisted by reserving the
+# next block in the file under an exclusive OS-level file lock, so issuing a
+# serial is usually just a locked integer increment, concurrent worker
+# processes draw from disjoint ranges, and a crash can skip a few serials but
+# never repeat one.
+SERIAL_BLOCK_SIZE = 10
+
+_serial_lock = threading.Lock()
+_serial_base = None
+_serial_next = None
+_serial_reserved = None
+
+
+def _reserve_serial_block():
+    """Claim the next block of serials by re-reading the file under flock."""
+    global _serial_base, _serial_next, _serial_reserved
+    with open(SERIAL_FILE, "r+") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        base, counter = map(int, f.read().strip().split(","))
+        _serial_base = base
+        _serial_next = counter
+        _serial_reserved = counter + SERIAL_BLOCK_SIZE
+        f.seek(0)
+        f.truncate()
+        f.write(f"{base},{_serial_reserved}")
 
-    # Increment the counter and update the file
-    with open(SERIAL_FILE, "w") as f:
-        f.write(f"{base_number},{counter + 1}")
 
-    return serial_number
+def get_serial_number():
+    global _serial_next
+    with _serial_lock:
+        if _serial_next is None or _serial_next >= _serial_reserved:
+            _reserve_serial_block()
+        counter = _serial_next
+        _serial_next += 1
+    return _serial_base + counter
+
+
+@atexit.register
+def _save_serial_state():
+    """Return this process's unused reserved serials on clean shutdown."""
+    with _serial_lock:
+        if _serial_next is None:
+            return
+        with open(SERIAL_FILE, "r+") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            base, counter = map(int, f.read().strip().split(","))
+            # Only roll back when no other process has reserved past us.
+            if counter == _serial_reserved:
+                f.seek(0)
+                f.truncate()
+                f.write(f"{base},{_serial_next}")
 
 def generate_reference_number(company_name="BKR"):
     """
     Generate the full reference number in the format: BKRMM-YYYY-CR<serial>.
     """
-    current_month = datetime.now().strftime("%m")
-    current_year = datetime.now().strftime("%Y")
+    now = datetime.now()
     serial_number = get_serial_number()
-    return f"{company_name}{current_month}-{current_year}-CR{serial_number}"
+    return f"{company_name}{now.month:02d}-{now.year}-CR{serial_number}"
+
+@functools.lru_cache(maxsize=8)
+def _load_template(path, mtime):
+    """
+    Parse a .docx template once per (path, mtime). Unzipping and parsing the
+    XML is the expensive part; callers must deepcopy before mutating.
+    """
+    return Document(path)
+
+
+@functools.lru_cache(maxsize=32)
+def _placeholder_pattern(keys):
+    """
+    Compile the placeholder keys into one alternation regex. Submissions for
+    the same template reuse the same key set, so the compile is paid once.
+    """
+    return re.compile("|".join(re.escape(key) for key in keys))
+
+
+def _is_text_part(name):
+    """True for the .docx parts that carry document text."""
+    if name == "word/document.xml":
+        return True
+    return name.startswith(("word/header", "word/footer")) and name.endswith(".xml")
+
+
+def replace_placeholders_zip(template_path, output_path, placeholders):
+    """
+    Substitute placeholders at the raw XML level, bypassing python-docx.
+
+    The .docx is treated as a zip of XML and each placeholder is replaced
+    with a single bytes.replace per text part, which is far cheaper than
+    walking paragraphs, cells and runs. Keys and values are XML-escaped so
+    they match the way Word stores '<<Name>>' (as '&lt;&lt;Name&gt;&gt;').
+
+    Returns True on success. Returns False without writing anything when a
+    '<<' marker survives substitution - that means a placeholder is split
+    across runs (or was not submitted), so the caller should fall back to
+    the python-docx path.
+    """
+    entries = []
+    with zipfile.ZipFile(template_path) as zin:
+        for item in zin.infolist():
+            data = zin.read(item.filename)
+            if _is_text_part(item.filename):
+                for key, value in placeholders.items():
+                    data = data.replace(
+                        xml_escape(key).encode("utf-8"),
+                        xml_escape(value).encode("utf-8")
+                    )
+                if b"&lt;&lt;" in data:
+                    return False
+            entries.append((item, data))
+
+    with zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED) as zout:
+        for item, data in entries:
+            zout.writestr(item, data)
+    return True
+
 
 # Code to replace placeholder for VAT
 def replace_placeholders_vat(doc, placeholders):
     """Replace placeholders in a Word document, maintaining original formatting."""
-    
-    def replace_in_paragraph(paragraph, key, value):
+    if not placeholders:
+        return doc
+
+    pattern = _placeholder_pattern(tuple(placeholders))
+
+    def substitute(match):
+        return placeholders[match.group(0)]
+
+    def replace_in_paragraph(paragraph):
         """Replace placeholders in a paragraph, preserving formatting."""
+        if "<<" not in paragraph.text:
+            return
         for run in paragraph.runs:
-            if key in run.text:
+            new_text, count = pattern.subn(substitute, run.text)
+            if count:
                 # Replace placeholder text
-                run.text = run.text.replace(key, value)
+                run.text = new_text
                 # Retain original font style and size
                 run.font.name = paragraph.style.font.name
                 run.font.size = paragraph.style.font.size
 
-    def replace_in_cell(cell, placeholders):
+    def replace_in_cell(cell):
         """Replace placeholders inside a table cell."""
+        if "<<" not in cell.text:
+            return
         for para in cell.paragraphs:
-            for key, value in placeholders.items():
-                replace_in_paragraph(para, key, value)
+            replace_in_paragraph(para)
 
     # Replace placeholders in all paragraphs
     for para in doc.paragraphs:
-        for key, value in placeholders.items():
-            replace_in_paragraph(para, key, value)
+        replace_in_paragraph(para)
 
     # Replace placeholders in tables
     for table in doc.tables:
         for row in table.rows:
             for cell in row.cells:
-                replace_in_cell(cell, placeholders)
+                replace_in_cell(cell)
 
     return doc
 
 def replace_placeholders(doc, placeholders):
     """Replace placeholders in a Word document, including paragraphs and tables."""
-    
-    def replace_in_paragraph(paragraph, key, value):
+    if not placeholders:
+        return doc
+
+    pattern = _placeholder_pattern(tuple(placeholders))
+
+    def substitute(match):
+        return placeholders[match.group(0)]
+
+    def replace_in_paragraph(paragraph):
         """Replace placeholders in a single paragraph, handling split runs."""
+        if "<<" not in paragraph.text:
+            return
+        # Normalized templates (scripts/normalize_templates.py) keep each
+        # placeholder inside one run, so a per-run substitution usually
+        # suffices and preserves the runs' formatting.
+        for run in paragraph.runs:
+            if "<<" in run.text:
+                run.text = pattern.sub(substitute, run.text)
+        if "<<" not in paragraph.text:
+            return
+        # Fallback for placeholders still split across runs.
         full_text = "".join(run.text for run in paragraph.runs)
-        if key in full_text:
-            full_text = full_text.replace(key, value)
+        new_text, count = pattern.subn(substitute, full_text)
+        if count:
             for run in paragraph.runs:
                 run.text = ""  # Clear all runs
-            paragraph.runs[0].text = full_text  # Add the replaced text back
+            paragraph.runs[0].text = new_text  # Add the replaced text back
 
-    def replace_in_cell(cell, placeholders):
+    def replace_in_cell(cell):
         """Replace placeholders inside a table cell."""
+        if "<<" not in cell.text:
+            return
         for para in cell.paragraphs:
-            for key, value in placeholders.items():
-                replace_in_paragraph(para, key, value)
+            replace_in_paragraph(para)
 
     # Replace placeholders in all paragraphs
     for para in doc.paragraphs:
-        for key, value in placeholders.items():
-            replace_in_paragraph(para, key, value)
+        replace_in_paragraph(para)
 
     # Replace placeholders in tables
     for table in doc.tables:
         for row in table.rows:
             for cell in row.cells:
-                replace_in_cell(cell, placeholders)
+                replace_in_cell(cell)
 
     return doc
   
 
+# Persistent LibreOffice process, shared by all requests. Starting soffice
+# (font cache, UNO bootstrap, profile init) takes seconds, so forking it per
+# conversion dominates wall time for small documents.
+UNOSERVER_PORT = int(os.environ.get("UNOSERVER_PORT", 2003))
+# unoserver needs the UNO bindings, which Debian ships for the system Python
+# (python3-uno), not necessarily the interpreter running this app - see the
+# Dockerfile, which installs unoserver for the system interpreter.
+UNOSERVER_PYTHON = os.environ.get("UNOSERVER_PYTHON", "/usr/bin/python3")
+_uno_server = None
+_uno_server_lock = threading.Lock()
+_uno_server_failed = False  # startup failures are remembered, not retried
+_convert_lock = threading.Lock()  # UNO handles one conversion at a time
+_word_app = None  # cached Word.Application instance on Windows
+
+
+def _ensure_unoserver():
+    """Start unoserver (a warm soffice) on first use; True when reachable."""
+    global _uno_server, _uno_server_failed
+    with _uno_server_lock:
+        if _uno_server_failed:
+            return False
+        if _uno_server is not None and _uno_server.poll() is None:
+            return True
+        if not os.path.exists(UNOSERVER_PYTHON) or shutil.which("unoconvert") is None:
+            _uno_server_failed = True
+            return False
+        try:
+            _uno_server = subprocess.Popen(
+                [UNOSERVER_PYTHON, "-m", "unoserver.server", "--port", str(UNOSERVER_PORT)],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL
+            )
+        except OSError:
+            _uno_server_failed = True
+            return False
+        # Wait for the UNO bridge to accept connections before converting
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            if _uno_server.poll() is not None:
+                break  # died during startup (e.g. missing uno bindings)
+            try:
+                socket.create_connection(("127.0.0.1", UNOSERVER_PORT), timeout=1).close()
+                return True
+            except OSError:
+                time.sleep(0.5)
+        _uno_server_failed = True
+        return False
+
+
 def convert_to_pdf(doc_path, pdf_path):
     doc_path = os.path.abspath(doc_path)
     pdf_path = os.path.abspath(pdf_path)
@@ -110,93 +307,293 @@ def convert_to_pdf(doc_path, pdf_path):
 
     if platform.system() == "Windows":
         try:
+            global _word_app
             import comtypes.client
             import pythoncom
             pythoncom.CoInitialize()
-            word = comtypes.client.CreateObject("Word.Application")
-            word.Visible = False
-            doc = word.Documents.Open(doc_path)
-            doc.SaveAs(pdf_path, FileFormat=17)
-            doc.Close()
-            word.Quit()
+            with _convert_lock:
+                if _word_app is None:
+                    _word_app = comtypes.client.CreateObject("Word.Application")
+                    _word_app.Visible = False
+                doc = _word_app.Documents.Open(doc_path)
+                doc.SaveAs(pdf_path, FileFormat=17)
+                doc.Close()
         except Exception as e:
+            # Drop the cached instance: if Word crashed or was closed, the
+            # next call recreates it instead of failing forever.
+            _word_app = None
             raise Exception(f"Error using COM on Windows: {e}")
     else:
+        # Optional pure-Rust converter: a single static binary with ~10ms
+        # startup, so it beats even a warm soffice when installed.
+        if shutil.which("libreoffice-pure"):
+            try:
+                subprocess.run(
+                    ['libreoffice-pure', 'docx2pdf', doc_path, pdf_path],
+                    check=True
+                )
+                return
+            except (OSError, subprocess.CalledProcessError):
+                pass  # fall back to LibreOffice below
+        if _ensure_unoserver():
+            try:
+                with _convert_lock:
+                    subprocess.run(
+                        ['unoconvert', '--port', str(UNOSERVER_PORT), '--convert-to', 'pdf', doc_path, pdf_path],
+                        check=True
+                    )
+                return
+            except (OSError, subprocess.CalledProcessError):
+                pass  # fall back to a one-shot LibreOffice below
         try:
+            # A per-process user profile stops parallel gunicorn workers from
+            # serializing on LibreOffice's profile lock.
+            profile = f"-env:UserInstallation=file:///tmp/lo-profile-{os.getpid()}"
             subprocess.run(
-                ['libreoffice', '--headless', '--convert-to', 'pdf', '--outdir', os.path.dirname(pdf_path), doc_path],
+                ['libreoffice', '--headless', profile, '--convert-to', 'pdf', '--outdir', os.path.dirname(pdf_path), doc_path],
                 check=True
             )
         except subprocess.CalledProcessError as e:
             raise Exception(f"Error using LibreOffice: {e}")
 
 
+def flatten_pdf(input_pdf_path, output_pdf_path):
+    """
+    Make a PDF non-editable by scrubbing metadata, form fields and embedded
+    content. Works directly on the PDF objects, so no pages are rasterized.
+    """
+    doc = fitz.open(input_pdf_path)
+    doc.scrub(
+        metadata=True,
+        xml_metadata=True,
+        attached_files=True,
+        embedded_files=True,
+        thumbnails=True,
+        reset_fields=True,
+        reset_responses=True
+    )
+    temp_path = output_pdf_path + ".tmp"
+    doc.ez_save(temp_path)
+    doc.close()
+    os.replace(temp_path, output_pdf_path)
+
+
 def generate_unique_reference():
     """
     Generate a unique reference number based on the current date and time in the format:
     DDMMYYYYHHMMSS
     """
     now = datetime.now()
-    return now.strftime("%d%m%Y%H%M%S")
-
-@app.route('/generate-document', methods=['POST'])
-def generate_document():
-    """API endpoint to generate a document."""
-    data = request.json
-    template_type = data.get("template_type")
-    placeholders = data.get("placeholders", {})
-
+    return (
+        f"{now.day:02d}{now.month:02d}{now.year}"
+        f"{now.hour:02d}{now.minute:02d}{now.second:02d}"
+    )
+
+TEMPLATE_PATHS = {
+    "VAT": "SAMPLE VAT registration and VAT filling -SME package.docx",
+    "Service Agreement": "SAMPLE Service Agreement -Company formation -Bahrain - Filled.docx",
+    "Invoice": "SAMPLE -Invoice BKR2024CF158 - first payment.docx"
+}
+
+# Generation runs off the request thread: /generate-document returns a job id
+# immediately instead of holding an HTTP worker through the multi-second PDF
+# conversion. Each job has a progress queue (streamed over SSE) and a result.
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+_jobs = {}
+_job_results = {}
+
+# Finished documents are held in memory and streamed to the client instead of
+# accumulating in the working directory; entries expire after RESULT_TTL.
+RESULT_TTL = 15 * 60  # seconds
+_job_files = {}
+
+
+def _sweep_expired_jobs():
+    cutoff = time.time() - RESULT_TTL
+    # Iterate over snapshots: executor threads insert into these dicts while
+    # the sweep runs on the request thread, and a concurrent insert during
+    # iteration would raise RuntimeError.
+    for job_id, files in list(_job_files.items()):
+        if files["created"] < cutoff:
+            _job_files.pop(job_id, None)
+    # Progress queues whose events were never consumed expire too, so clients
+    # that only poll /job (or never come back) don't leak queues forever.
+    for job_id, job in list(_jobs.items()):
+        if job["created"] < cutoff:
+            _jobs.pop(job_id, None)
+    # Results carry their own stamp so failed jobs, which never produce a
+    # _job_files entry, are reclaimed as well.
+    for job_id, entry in list(_job_results.items()):
+        if entry["created"] < cutoff:
+            _job_results.pop(job_id, None)
+
+
+def _job_progress(job_id, pct, msg, **extra):
+    job = _jobs.get(job_id)
+    if job is None:
+        return  # progress queue already swept or consumed
+    event = {"pct": pct, "msg": msg}
+    event.update(extra)
+    job["queue"].put(event)
+
+
+def _run_generation(job_id, template_type, template_path, placeholders):
+    """Worker that generates the document and records the job result."""
     try:
         reference_number = generate_reference_number()
         placeholders["<<Reference Number>>"] = reference_number
-
-        template_paths = {
-            "VAT": "SAMPLE VAT registration and VAT filling -SME package.docx",
-            "Service Agreement": "SAMPLE Service Agreement -Company formation -Bahrain - Filled.docx",
-            "Invoice": "SAMPLE -Invoice BKR2024CF158 - first payment.docx"
+        _job_progress(job_id, 10, "Filling template")
+
+        word_name = f"{template_type} {reference_number}.docx"
+        pdf_name = word_name.replace(".docx", ".pdf")
+
+        # Work in a scratch directory (LibreOffice needs real files) and keep
+        # only the in-memory results, so nothing lands in the app directory.
+        with tempfile.TemporaryDirectory() as workdir:
+            word_output = os.path.join(workdir, word_name)
+            pdf_output = os.path.join(workdir, pdf_name)
+
+            # Fast path: substitute directly in the zipped XML. Fall back to
+            # the python-docx replacer when a placeholder is split across runs.
+            if not replace_placeholders_zip(template_path, word_output, placeholders):
+                template_mtime = os.path.getmtime(template_path)
+                doc = copy.deepcopy(_load_template(template_path, template_mtime))
+                doc = replace_placeholders(doc, placeholders)
+                doc.save(word_output)
+
+            _job_progress(job_id, 40, "Converting to PDF")
+            convert_to_pdf(word_output, pdf_output)
+            _job_progress(job_id, 80, "Flattening PDF")
+            flatten_pdf(pdf_output, pdf_output)
+
+            with open(word_output, "rb") as f:
+                docx_bytes = f.read()
+            with open(pdf_output, "rb") as f:
+                pdf_bytes = f.read()
+
+        _job_files[job_id] = {
+            "docx": (word_name, docx_bytes),
+            "pdf": (pdf_name, pdf_bytes),
+            "created": time.time()
         }
+        result = {
+            "status": "success",
+            "reference_number": reference_number,
+            "word_document": word_name,
+            "pdf_document": pdf_name,
+            "download_url": f"/download/{job_id}"
+        }
+    except Exception as e:
+        result = {"status": "error", "message": str(e)}
 
-        template_path = template_paths.get(template_type)
-        if not template_path or not os.path.exists(template_path):
-            return jsonify({"status": "error", "message": "Invalid template type or template not found!"}), 400
-
-        doc = Document(template_path)
-        doc = replace_placeholders(doc, placeholders)
+    _job_results[job_id] = {"result": result, "created": time.time()}
+    _job_progress(job_id, 100, "Done", done=True, result=result)
 
-        word_output = f"{template_type} {reference_number}.docx"
-        pdf_output = word_output.replace(".docx", ".pdf")
 
-        doc.save(word_output)
-        convert_to_pdf(word_output, pdf_output)
+@app.route('/generate-document', methods=['POST'])
+def generate_document():
+    """API endpoint to generate a document. Returns a job id immediately."""
+    data = request.json
+    template_type = data.get("template_type")
+    placeholders = data.get("placeholders", {})
 
-        return jsonify({
-            "status": "success",
-            "reference_number": reference_number,
-            "word_document": word_output,
-            "pdf_document": pdf_output
-        })
+    template_path = TEMPLATE_PATHS.get(template_type)
+    if not template_path or not os.path.exists(template_path):
+        return jsonify({"status": "error", "message": "Invalid template type or template not found!"}), 400
+
+    _sweep_expired_jobs()
+    job_id = uuid.uuid4().hex
+    _jobs[job_id] = {"queue": queue.Queue(), "created": time.time()}
+    _executor.submit(_run_generation, job_id, template_type, template_path, placeholders)
+
+    return jsonify({"status": "accepted", "job_id": job_id}), 202
+
+
+@app.route('/progress/<job_id>', methods=['GET'])
+def job_progress(job_id):
+    """Stream job progress as server-sent events until the job finishes."""
+    job = _jobs.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Job not found!"}), 404
+    progress_queue = job["queue"]
+
+    def stream():
+        while True:
+            try:
+                event = progress_queue.get(timeout=5)
+            except queue.Empty:
+                # The 'done' event may never arrive on this queue: another
+                # client can consume it, or the job entry may get swept.
+                # Fall back to the recorded result rather than blocking a
+                # worker thread forever.
+                entry = _job_results.get(job_id)
+                if entry is not None:
+                    done = {"pct": 100, "msg": "Done", "done": True, "result": entry["result"]}
+                    yield f"data: {json.dumps(done)}\n\n"
+                    _jobs.pop(job_id, None)
+                    break
+                if job_id not in _jobs:
+                    break
+                continue
+            yield f"data: {json.dumps(event)}\n\n"
+            if event.get("done"):
+                _jobs.pop(job_id, None)
+                break
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream')
+
+
+@app.route('/job/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Poll a job's result without streaming."""
+    entry = _job_results.get(job_id)
+    if entry is not None:
+        return jsonify(entry["result"])
+    if job_id in _jobs:
+        return jsonify({"status": "pending"})
+    return jsonify({"status": "error", "message": "Job not found!"}), 404
+
+@app.route('/download/<job_id>', methods=['GET'])
+def download_file(job_id):
+    """API endpoint to download a generated document (pdf or docx)."""
+    files = _job_files.get(job_id)
+    if files is None:
+        return jsonify({"status": "error", "message": "File not found!"}), 404
 
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
+    file_format = request.args.get("format", "pdf")
+    if file_format not in ("pdf", "docx"):
+        return jsonify({"status": "error", "message": "Unknown format!"}), 400
 
-@app.route('/download/<filename>', methods=['GET'])
-def download_file(filename):
-    """API endpoint to download a generated document."""
-    if os.path.exists(filename):
-        return send_file(filename, as_attachment=True)
+    name, data = files[file_format]
+    if file_format == "pdf":
+        mimetype = "application/pdf"
     else:
-        return jsonify({"status": "error", "message": "File not found!"}), 404
+        mimetype = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+    # conditional=True enables If-Modified-Since/If-None-Match 304s and Range
+    # requests, so interrupted or repeated downloads don't resend the body.
+    return send_file(
+        io.BytesIO(data),
+        as_attachment=True,
+        download_name=name,
+        mimetype=mimetype,
+        conditional=True,
+        etag=f"{job_id}-{file_format}",
+        last_modified=files["created"]
+    )
 
 @app.route("/", methods=["GET"])
 def home():
     return jsonify({
         "message": "Document Generation API is running!",
         "endpoints": {
-            "POST /generate-document": "Generate a document with placeholders",
-            "GET /download/<filename>": "Download a generated document"
+            "POST /generate-document": "Submit a generation job, returns a job id",
+            "GET /progress/<job_id>": "Stream job progress as server-sent events",
+            "GET /job/<job_id>": "Poll a job's result",
+            "GET /download/<job_id>": "Download a generated document (?format=pdf|docx)"
         }
     })
 
 if __name__ == '__main__':
+    # Development only - production runs under gunicorn (see Dockerfile).
     port = int(os.environ.get("PORT", 8080))
-    app.run(host="0.0.0.0", port=port)
+    app.run(host="0.0.0.0", port=port, threaded=True)
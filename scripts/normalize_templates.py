@@ -0,0 +1,95 @@
+"""
+One-time template maintenance: collapse the runs of any paragraph that
+contains a <<placeholder>> marker into a single run.
+
+Word splits placeholders across runs at spellcheck and formatting
+boundaries, which forces the API to merge runs on every request. After
+normalizing, each placeholder sits inside one run, so both the raw-XML
+fast path and the per-run replacer in api.py work without fallbacks.
+
+Run from the repository root: python scripts/normalize_templates.py
+"""
+import os
+import re
+import sys
+import zipfile
+
+from docx import Document
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api import TEMPLATE_PATHS
+
+
+def iter_paragraphs(doc):
+    """Yield every paragraph in the document body, tables and sections."""
+    for para in doc.paragraphs:
+        yield para
+    for table in doc.tables:
+        for row in table.rows:
+            for cell in row.cells:
+                yield from cell.paragraphs
+    for section in doc.sections:
+        for part in (section.header, section.footer):
+            yield from part.paragraphs
+
+
+def normalize_paragraph(paragraph):
+    """Merge a placeholder paragraph's runs into one; True if changed."""
+    if "<<" not in paragraph.text:
+        return False
+    if sum(1 for run in paragraph.runs if run.text) < 2:
+        return False
+    text = "".join(run.text for run in paragraph.runs)
+    for run in paragraph.runs:
+        run.text = ""
+    paragraph.runs[0].text = text
+    return True
+
+
+_EMBED_REF = re.compile(rb"<w:embed(?:Regular|Bold|Italic|BoldItalic)\b[^>]*/>")
+_FONT_REL = re.compile(rb'<Relationship\b[^>]*Target="fonts/[^>]*/>')
+
+
+def strip_embedded_fonts(template_path):
+    """
+    Drop embedded font payloads and their fontTable references so LibreOffice
+    does not have to initialize them on every conversion. Word embeds fonts
+    when "Embed fonts in the file" is enabled; the converters fall back to
+    the installed system fonts. Returns the number of font parts removed.
+    """
+    with zipfile.ZipFile(template_path) as zin:
+        if not any(n.startswith("word/fonts/") for n in zin.namelist()):
+            return 0
+        entries = []
+        removed = 0
+        for item in zin.infolist():
+            name = item.filename
+            if name.startswith("word/fonts/"):
+                removed += 1
+                continue
+            data = zin.read(name)
+            if name == "word/fontTable.xml":
+                data = _EMBED_REF.sub(b"", data)
+            elif name == "word/_rels/fontTable.xml.rels":
+                data = _FONT_REL.sub(b"", data)
+            entries.append((item, data))
+
+    with zipfile.ZipFile(template_path, "w", zipfile.ZIP_DEFLATED) as zout:
+        for item, data in entries:
+            zout.writestr(item, data)
+    return removed
+
+
+def main():
+    for template_path in TEMPLATE_PATHS.values():
+        doc = Document(template_path)
+        changed = sum(normalize_paragraph(para) for para in iter_paragraphs(doc))
+        if changed:
+            doc.save(template_path)
+        removed = strip_embedded_fonts(template_path)
+        print(f"{template_path}: normalized {changed} paragraph(s), "
+              f"removed {removed} embedded font(s)")
+
+
+if __name__ == "__main__":
+    main()